@@ -1,17 +1,64 @@
+import atexit
+import importlib
 import logging
+import operator
 import os
-import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import orjson
+from botocore.config import Config
 
-import bi_snowflake_connector
-from snowflake.connector.errors import ProgrammingError
+# bi_snowflake_connector and snowflake.connector are imported inside the steps that talk to Snowflake, so that
+# createSecret and finishSecret cold starts don't pay for loading the Snowflake SDK
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logging.getLogger('snowflake').setLevel(logging.WARNING)
 logging.getLogger('boto3').setLevel(logging.WARNING)
 
+# Secrets Manager staging labels
+AWSCURRENT = 'AWSCURRENT'
+AWSPENDING = 'AWSPENDING'
+
+# Created once per container so warm invocations reuse the client and its connection pool
+SECRETS_CLIENT = boto3.client('secretsmanager', config=Config(
+    tcp_keepalive=True,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    max_pool_connections=4,
+    # Every call site passes fixed, well-typed arguments; the service still rejects bad ones
+    parameter_validation=False,
+))
+
+# Characters left out of generated passwords; the environment is fixed for the life of the container
+EXCLUDE_CHARACTERS = os.environ.get('EXCLUDE_CHARACTERS', '/@"\'\\`')
+
+# Secret tags that let createSecret skip reading AWSCURRENT. Both must be set for the shortcut to apply:
+#   username=<Snowflake user>    the user whose password is rotated; it is trusted over the username in the secret
+#   username_only_secret=true    asserts the secret holds only username and password, since any other key is dropped
+# Without them the username and every other key are read from AWSCURRENT.
+USERNAME_TAG = 'username'
+USERNAME_ONLY_TAG = 'username_only_secret'
+
+# Pulls (SecretId, ClientRequestToken, Step) out of the rotation event
+_get_event = operator.itemgetter('SecretId', 'ClientRequestToken', 'Step')
+
+# describe_secret results keyed by (arn, token) as (expiry, metadata), shared across warm invocations
+_METADATA_CACHE = {}
+METADATA_CACHE_TTL = float(os.environ.get('METADATA_CACHE_TTL', 30))
+
+# describe_secret returns at most this many entries in VersionIdsToStages
+DESCRIBE_VERSION_LIMIT = 20
+
+# Open the admin Snowflake connection with SECURITYADMIN as its session role instead of running USE ROLE per rotation.
+# Set to false if the connector can't take a role at connect time.
+CONNECT_AS_SECURITYADMIN = os.environ.get('CONNECT_AS_SECURITYADMIN', 'true').lower() == 'true'
+
+# Admin Snowflake connection, cached across warm invocations (see _get_snow)
+_SNOW_CON = None
+
 def handler(event, context):
     """Secrets Manager Rotation Template
 
@@ -33,53 +80,43 @@ def handler(event, context):
         KeyError: If the event parameters do not contain the expected keys
 
     """
-    arn = event['SecretId']
-    token = event['ClientRequestToken']
-    step = event['Step']
-    logging.info(f'Begin password rotation step {step} for {arn} with token {token}...')
+    arn, token, step = _get_event(event)
+    logger.info('Begin password rotation step %s for %s with token %s...', step, arn, token)
 
-    # Setup the client
-    logging.info(f'Connect to secretsmanager...')
-    service_client = boto3.client('secretsmanager')
+    service_client = SECRETS_CLIENT
 
-    # Make sure the version is staged correctly
-    metadata = service_client.describe_secret(SecretId=arn)
+    # Make sure the version is staged correctly. finishSecret moves stages around, so always start it from fresh metadata
+    metadata = describe_secret(service_client, arn, token, use_cache=step != "finishSecret")
     if not metadata['RotationEnabled']:
-        logger.error("Secret %s is not enabled for rotation" % arn)
+        logger.error("Secret %s is not enabled for rotation", arn)
         raise ValueError("Secret %s is not enabled for rotation" % arn)
     versions = metadata['VersionIdsToStages']
     if token not in versions:
-        logger.error("Secret version %s has no stage for rotation of secret %s." % (token, arn))
+        logger.error("Secret version %s has no stage for rotation of secret %s.", token, arn)
         raise ValueError("Secret version %s has no stage for rotation of secret %s." % (token, arn))
-    if "AWSCURRENT" in versions[token]:
-        logger.info("Secret version %s already set as AWSCURRENT for secret %s." % (token, arn))
+    stages = versions[token]
+    if AWSCURRENT in stages:
+        logger.info("Secret version %s already set as AWSCURRENT for secret %s.", token, arn)
         return
-    elif "AWSPENDING" not in versions[token]:
-        logger.error("Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
+    elif AWSPENDING not in stages:
+        logger.error("Secret version %s not set as AWSPENDING for rotation of secret %s.", token, arn)
         raise ValueError("Secret version %s not set as AWSPENDING for rotation of secret %s." % (token, arn))
 
-    if step == "createSecret":
-        create_secret(service_client, arn, token)
-
-    elif step == "setSecret":
-        set_secret(service_client, arn, token)
-
-    elif step == "testSecret":
-        test_secret(service_client, arn, token)
-
-    elif step == "finishSecret":
-        finish_secret(service_client, arn, token)
-
-    else:
+    step_fn = _STEPS.get(step)
+    if step_fn is None:
         raise ValueError("Invalid step parameter")
+    step_fn(service_client, arn, token, metadata)
 
 
-def create_secret(service_client, arn, token):
+def create_secret(service_client, arn, token, metadata):
     """Create the secret
 
     This method first checks for the existence of a secret for the passed in token. If one does not exist, it will
     generate a new secret and put it with the passed in token.
 
+    If the secret carries both the USERNAME_TAG and USERNAME_ONLY_TAG tags, the new secret is built from the tag
+    without reading AWSCURRENT. Otherwise the current secret is read so that every other key is carried over.
+
     Args:
         service_client (client): The secrets manager service client
 
@@ -87,36 +124,51 @@ def create_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        metadata (dict): The describe_secret response already fetched by the handler
+
     Raises:
         ResourceNotFoundException: If the secret with the specified arn and stage does not exist
 
     """
-    logging.info('createSecret: Started...')
-    logging.info(f'Get AWSCURRENT secret value of {arn}...')
-    current_secret = service_client.get_secret_value(SecretId=arn, VersionStage="AWSCURRENT")
-
+    logger.info('createSecret: Started...')
     try:
-        service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage="AWSPENDING")
-        logging.warning('AWSPENDING version already exists, skip generating a new secret...')
-        logger.info("createSecret: Successfully retrieved secret for %s." % arn)
+        service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage=AWSPENDING)
+        logger.warning('AWSPENDING version already exists, skip generating a new secret...')
+        logger.info("createSecret: Successfully retrieved secret for %s.", arn)
     except service_client.exceptions.ResourceNotFoundException:
-        logging.info('Generate new secret...')
-        exclude_characters = os.environ['EXCLUDE_CHARACTERS'] if 'EXCLUDE_CHARACTERS' in os.environ else '/@"\'\\`'
-        passwd = service_client.get_random_password(ExcludeCharacters=exclude_characters)
-
-        current_secret_str = json.loads(current_secret['SecretString'])
-        username = current_secret_str.pop('username')
-        current_secret_str.pop('password')
-
-        secret_str = json.dumps({"username": username, "password": passwd['RandomPassword'], **current_secret_str})
-
-        logging.info('Put new secret as AWSPENDING...')
+        tags = {tag['Key']: tag['Value'] for tag in metadata.get('Tags', [])}
+        username = tags.get(USERNAME_TAG)
+        if username is not None and tags.get(USERNAME_ONLY_TAG, '').lower() == 'true':
+            logger.info('Using username %s from tags without reading AWSCURRENT, the new secret will only hold '
+                        'username and password...', username)
+            logger.info('Generate new secret...')
+            passwd = service_client.get_random_password(ExcludeCharacters=EXCLUDE_CHARACTERS)
+            current_secret_str = {}
+        else:
+            # The two calls are independent, so overlap them
+            logger.info('Get AWSCURRENT secret value of %s and generate new secret...', arn)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                current_future = executor.submit(service_client.get_secret_value, SecretId=arn,
+                                                 VersionStage=AWSCURRENT)
+                passwd_future = executor.submit(service_client.get_random_password,
+                                                ExcludeCharacters=EXCLUDE_CHARACTERS)
+                current_secret = current_future.result()
+                passwd = passwd_future.result()
+
+            current_secret_str = orjson.loads(current_secret['SecretString'])
+            username = current_secret_str.pop('username')
+            current_secret_str.pop('password')
+
+        secret_str = orjson.dumps({"username": username, "password": passwd['RandomPassword'],
+                                   **current_secret_str}).decode()
+
+        logger.info('Put new secret as AWSPENDING...')
         service_client.put_secret_value(SecretId=arn, ClientRequestToken=token, SecretString=secret_str,
-                                        VersionStages=['AWSPENDING'])
-        logger.info("createSecret: Successfully put secret for ARN %s and version %s." % (arn, token))
+                                        VersionStages=[AWSPENDING])
+        logger.info("createSecret: Successfully put secret for ARN %s and version %s.", arn, token)
 
 
-def set_secret(service_client, arn, token):
+def set_secret(service_client, arn, token, metadata):
     """Set the secret
 
     This method should set the AWSPENDING secret in the service that the secret belongs to. For example, if the secret
@@ -130,37 +182,40 @@ def set_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        metadata (dict): The describe_secret response already fetched by the handler (unused)
+
     """
-    logging.info('setSecret: Started...')
-    logging.info(f'Get AWSPENDING version of secret {arn}...')
-    secret = service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage="AWSPENDING")
-    secret_str = json.loads(secret['SecretString'])
+    from snowflake.connector.errors import ProgrammingError
+
+    logger.info('setSecret: Started...')
+    logger.info('Get AWSPENDING version of secret %s...', arn)
+    secret = service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage=AWSPENDING)
+    secret_str = orjson.loads(secret['SecretString'])
 
     username = secret_str['username']
     password = secret_str['password']
 
-    # Get Terraform Snowflake Connection Details
-    svc_arn = 'arn:aws:secretsmanager:us-west-2:542960883369:secret:terraform/snowflake/pitchbook/secrets'
-    svc_secret = service_client.get_secret_value(SecretId=svc_arn, VersionStage="AWSCURRENT")
-    svc_user = 'SVC_BOT_TERRAFORM'
-    svc_pwd = json.loads(svc_secret['SecretString'])['terraform_bot_password']
-
     try:
-        with bi_snowflake_connector.connect(username=svc_user, password=svc_pwd) as snow_con:
-            with snow_con.cursor() as cursor:
-                logging.info(f'Set new password for {username}...')
-                cursor.execute("USE ROLE SECURITYADMIN;")
-                cursor.execute(f"ALTER USER {username} SET PASSWORD='{password}';")
+        cursor = _get_snow(service_client).cursor()
+        try:
+            logger.info('Set new password for %s...', username)
+            if CONNECT_AS_SECURITYADMIN:
+                cursor.execute("ALTER USER IDENTIFIER(%s) SET PASSWORD=%s;", (username, password))
+            else:
+                cursor.execute("USE ROLE SECURITYADMIN; ALTER USER IDENTIFIER(%s) SET PASSWORD=%s;",
+                               (username, password), num_statements=2)
+        finally:
+            cursor.close()
     except ProgrammingError as e:
         if e.errno == 3002:
-            logging.warning(f'PRIOR USE error detected, continuing without setting password...')
+            logger.warning('PRIOR USE error detected, continuing without setting password...')
         else:
             raise e
 
-    logger.info(f"setSecret: Successfully set secret for {arn} and version {token} in Snowflake.")
+    logger.info("setSecret: Successfully set secret for %s and version %s in Snowflake.", arn, token)
 
 
-def test_secret(service_client, arn, token):
+def test_secret(service_client, arn, token, metadata):
     """Test the secret
 
     This method should validate that the AWSPENDING secret works in the service that the secret belongs to. For example,
@@ -174,23 +229,35 @@ def test_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        metadata (dict): The describe_secret response already fetched by the handler (unused)
+
     """
-    logging.info('testSecret: Started...')
-    logging.info('Get AWSPENDING secret version...')
-    secret = service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage="AWSPENDING")
-    secret_str = json.loads(secret['SecretString'])
+    logger.info('testSecret: Started...')
+    logger.info('Get AWSPENDING secret version...')
+    if 'bi_snowflake_connector' in sys.modules:
+        import bi_snowflake_connector
+        secret = service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage=AWSPENDING)
+    else:
+        # The connection needs the fetched credentials, but loading the Snowflake SDK on a cold start does not. The
+        # worker's import also touches botocore/boto3 while this thread is inside a botocore call; both are already
+        # loaded by this module, so those imports resolve from sys.modules and only Snowflake's own modules are new.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            connector_future = executor.submit(importlib.import_module, 'bi_snowflake_connector')
+            secret = service_client.get_secret_value(SecretId=arn, VersionId=token, VersionStage=AWSPENDING)
+            bi_snowflake_connector = connector_future.result()
+    secret_str = orjson.loads(secret['SecretString'])
 
     username = secret_str['username']
     password = secret_str['password']
 
-    logging.info('Test connecting to Snowflake...')
+    logger.info('Test connecting to Snowflake...')
     snow_con = bi_snowflake_connector.connect(username=username, password=password)
     snow_con.close()
 
-    logger.info(f"testSecret: Successfully tested secret for {arn} and version {token} in Snowflake.")
+    logger.info("testSecret: Successfully tested secret for %s and version %s in Snowflake.", arn, token)
 
 
-def finish_secret(service_client, arn, token):
+def finish_secret(service_client, arn, token, metadata):
     """Finish the secret
 
     This method finalizes the rotation process by marking the secret version passed in as the AWSCURRENT secret.
@@ -202,30 +269,154 @@ def finish_secret(service_client, arn, token):
 
         token (string): The ClientRequestToken associated with the secret version
 
+        metadata (dict): The describe_secret response already fetched by the handler
+
     Raises:
         ResourceNotFoundException: If the secret with the specified arn does not exist
 
     """
-    # First describe the secret to get the current version
-    logging.info('finishSecret: Started...')
+    # Use the handler's describe_secret response to get the current version
+    logger.info('finishSecret: Started...')
+
+    # handler has already returned if the token is AWSCURRENT, so the version has to be moved
+    version_stages = metadata["VersionIdsToStages"]
+    if len(version_stages) >= DESCRIBE_VERSION_LIMIT:
+        # The map may be truncated, so stale AWSPENDING versions could be missing from it
+        version_stages = list_version_stages(service_client, arn)
+    version_stages = version_stages.items()
+    current_version = next((version for version, stages in version_stages if AWSCURRENT in stages), None)
+    # AWSPENDING on the token itself is cleared by Secrets Manager once rotation completes, only clean up stale ones
+    pending_versions = [version for version, stages in version_stages if AWSPENDING in stages and version != token]
+
+    logger.info('Set version %s as AWSCURRENT...', token)
+    service_client.update_secret_version_stage(SecretId=arn, VersionStage=AWSCURRENT, MoveToVersionId=token,
+                                               RemoveFromVersionId=current_version)
+    _METADATA_CACHE.pop((arn, token), None)
+    logger.info("finishSecret: Successfully set AWSCURRENT stage to version %s for secret %s.", token, arn)
+
+    for version in pending_versions:
+        logger.info('Cleanup: Remove AWSPENDING tag from %s...', version)
+        service_client.update_secret_version_stage(SecretId=arn, VersionStage=AWSPENDING,
+                                                   RemoveFromVersionId=version)
+
+
+# Rotation step name to the function that performs it, all called as fn(service_client, arn, token, metadata)
+_STEPS = {
+    "createSecret": create_secret,
+    "setSecret": set_secret,
+    "testSecret": test_secret,
+    "finishSecret": finish_secret,
+}
+
+
+def describe_secret(service_client, arn, token, use_cache=True):
+    """Describe the secret
+
+    Stage assignments only change in finishSecret, so the other steps of a rotation can share one describe_secret
+    response for up to METADATA_CACHE_TTL seconds.
+
+    Args:
+        service_client (client): The secrets manager service client
+
+        arn (string): The secret ARN or other identifier
+
+        token (string): The ClientRequestToken of the rotation the response is cached for
+
+        use_cache (bool): Whether the cache may be read and written
+
+    Returns:
+        dict: The describe_secret response
+
+    """
+    if not use_cache:
+        return service_client.describe_secret(SecretId=arn)
+
+    now = time.monotonic()
+    for key in [key for key, (expiry, _) in _METADATA_CACHE.items() if expiry <= now]:
+        del _METADATA_CACHE[key]
+
+    cached = _METADATA_CACHE.get((arn, token))
+    if cached is not None:
+        return cached[1]
 
     metadata = service_client.describe_secret(SecretId=arn)
-    current_version = None
-    pending_versions = []
-    for version in metadata["VersionIdsToStages"]:
-        if "AWSCURRENT" in metadata["VersionIdsToStages"][version]:
-            current_version = version
-        if "AWSPENDING" in metadata["VersionIdsToStages"][version]:
-            pending_versions.append(version)
-
-    if current_version == token:
-        logger.info("finishSecret: Version %s already marked as AWSCURRENT for %s" % (version, arn))
-    else:
-        logging.info(f'Set version {token} as AWSCURRENT...')
-        service_client.update_secret_version_stage(SecretId=arn, VersionStage="AWSCURRENT", MoveToVersionId=token,
-                                                   RemoveFromVersionId=current_version)
-        logger.info("finishSecret: Successfully set AWSCURRENT stage to version %s for secret %s." % (token, arn))
+    _METADATA_CACHE[arn, token] = (now + METADATA_CACHE_TTL, metadata)
+    return metadata
 
-    for version in pending_versions:
-        logging.info(f'Cleanup: Remove AWSPENDING tag from {version}...')
-        service_client.update_secret_version_stage(SecretId=arn, VersionStage="AWSPENDING", RemoveFromVersionId=token)
+
+def list_version_stages(service_client, arn):
+    """List the stages of every version of the secret
+
+    Unlike describe_secret, this follows NextToken through list_secret_version_ids so no labelled version is left out.
+
+    Args:
+        service_client (client): The secrets manager service client
+
+        arn (string): The secret ARN or other identifier
+
+    Returns:
+        dict: Map of version id to its list of stages, in the same shape as VersionIdsToStages
+
+    """
+    version_stages = {}
+    kwargs = {'SecretId': arn, 'IncludeDeprecated': False, 'MaxResults': 100}
+    while True:
+        page = service_client.list_secret_version_ids(**kwargs)
+        for version in page['Versions']:
+            version_stages[version['VersionId']] = version.get('VersionStages', [])
+        if 'NextToken' not in page:
+            return version_stages
+        kwargs['NextToken'] = page['NextToken']
+
+
+def _get_snow(service_client):
+    """Get the admin Snowflake connection
+
+    Returns the connection cached from a previous warm invocation if it still answers a ping, otherwise fetches the
+    Terraform service credentials and opens a new one.
+
+    Args:
+        service_client (client): The secrets manager service client
+
+    Returns:
+        SnowflakeConnection: An open connection as the Terraform service user
+
+    """
+    import bi_snowflake_connector
+    from snowflake.connector.errors import Error as SnowflakeError
+
+    global _SNOW_CON
+    if _SNOW_CON is not None and not _SNOW_CON.is_closed():
+        try:
+            with _SNOW_CON.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return _SNOW_CON
+        except SnowflakeError:
+            # Expired sessions surface as ProgrammingError (e.g. 390114), so treat any connector error as stale
+            logger.warning('Cached Snowflake connection is no longer usable, reconnecting...')
+            _close_snow()
+
+    # Get Terraform Snowflake Connection Details
+    svc_arn = 'arn:aws:secretsmanager:us-west-2:542960883369:secret:terraform/snowflake/pitchbook/secrets'
+    svc_secret = service_client.get_secret_value(SecretId=svc_arn, VersionStage=AWSCURRENT)
+    svc_user = 'SVC_BOT_TERRAFORM'
+    svc_pwd = orjson.loads(svc_secret['SecretString'])['terraform_bot_password']
+
+    logger.info('Connect to Snowflake...')
+    if CONNECT_AS_SECURITYADMIN:
+        _SNOW_CON = bi_snowflake_connector.connect(username=svc_user, password=svc_pwd, role='SECURITYADMIN')
+    else:
+        _SNOW_CON = bi_snowflake_connector.connect(username=svc_user, password=svc_pwd)
+    return _SNOW_CON
+
+
+@atexit.register
+def _close_snow():
+    """Close the cached admin Snowflake connection, if any"""
+    global _SNOW_CON
+    if _SNOW_CON is not None:
+        try:
+            _SNOW_CON.close()
+        except Exception:
+            pass
+        _SNOW_CON = None
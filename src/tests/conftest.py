@@ -0,0 +1,6 @@
+import os
+import sys
+
+# app builds its Secrets Manager client at import time, which needs a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,346 @@
+import sys
+import threading
+import types
+from concurrent.futures import Future
+
+import orjson
+import pytest
+from botocore.exceptions import ParamValidationError
+from botocore.stub import Stubber
+from botocore.validate import validate_parameters
+from snowflake.connector.errors import ProgrammingError
+
+import app
+
+ARN = 'arn:aws:secretsmanager:us-west-2:123456789012:secret:snowflake/test-AbCdEf'
+TOKEN = '11111111-1111-1111-1111-111111111111'
+CURRENT = '22222222-2222-2222-2222-222222222222'
+STALE = '33333333-3333-3333-3333-333333333333'
+SVC_ARN = 'arn:aws:secretsmanager:us-west-2:542960883369:secret:terraform/snowflake/pitchbook/secrets'
+
+
+class FakeCursor:
+    def __init__(self, error=None):
+        self.error = error
+        self.executed = []
+        self.closed = False
+
+    def execute(self, sql, params=None, **kwargs):
+        self.executed.append((sql, params, kwargs))
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeConnection:
+    def __init__(self, cursor=None):
+        self._cursor = cursor or FakeCursor()
+        self.closed = False
+
+    def cursor(self):
+        return self._cursor
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class SerialExecutor:
+    """Runs submitted calls inline so the stubbed responses are consumed in a fixed order"""
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def validate_shapes(params, model, **kwargs):
+    """Check every call against the service model, since SECRETS_CLIENT has parameter_validation off"""
+    validate_parameters(params, model.input_shape)
+
+
+@pytest.fixture(autouse=True)
+def stubber():
+    app._METADATA_CACHE.clear()
+    app._SNOW_CON = None
+    events = app.SECRETS_CLIENT.meta.events
+    # Registered ahead of the stubber so a malformed call fails validation before it looks for a queued response
+    events.register_first('before-parameter-build.*.*', validate_shapes)
+    try:
+        with Stubber(app.SECRETS_CLIENT) as stub:
+            yield stub
+            stub.assert_no_pending_responses()
+    finally:
+        events.unregister('before-parameter-build.*.*', validate_shapes)
+    app._METADATA_CACHE.clear()
+    app._SNOW_CON = None
+
+
+@pytest.fixture
+def connector(monkeypatch):
+    """Fake bi_snowflake_connector recording the arguments of every connect call"""
+    module = types.ModuleType('bi_snowflake_connector')
+    module.calls = []
+    module.connections = []
+
+    def connect(**kwargs):
+        module.calls.append(kwargs)
+        connection = FakeConnection()
+        module.connections.append(connection)
+        return connection
+
+    module.connect = connect
+    monkeypatch.setitem(sys.modules, 'bi_snowflake_connector', module)
+    return module
+
+
+def metadata(versions, tags=None):
+    response = {'ARN': ARN, 'Name': 'snowflake/test', 'RotationEnabled': True, 'VersionIdsToStages': versions}
+    if tags is not None:
+        response['Tags'] = [{'Key': key, 'Value': value} for key, value in tags.items()]
+    return response
+
+
+def secret_value(secret, version_id=TOKEN):
+    return {'ARN': ARN, 'Name': 'snowflake/test', 'VersionId': version_id,
+            'SecretString': orjson.dumps(secret).decode()}
+
+
+def event(step):
+    return {'SecretId': ARN, 'ClientRequestToken': TOKEN, 'Step': step}
+
+
+@pytest.mark.parametrize('operation, params', [
+    ('get_random_password', {'ExcludeCharacters': 123}),
+    ('put_secret_value', {'SecretId': ARN, 'SecretString': '{}', 'VersionStages': 'AWSPENDING'}),
+])
+def test_malformed_calls_fail_shape_validation(operation, params):
+    with pytest.raises(ParamValidationError):
+        getattr(app.SECRETS_CLIENT, operation)(**params)
+
+
+def test_handler_rejects_secret_without_rotation(stubber):
+    response = metadata({TOKEN: ['AWSPENDING']})
+    response['RotationEnabled'] = False
+    stubber.add_response('describe_secret', response, {'SecretId': ARN})
+
+    with pytest.raises(ValueError):
+        app.handler(event('createSecret'), None)
+
+
+def test_handler_rejects_invalid_step(stubber):
+    stubber.add_response('describe_secret', metadata({TOKEN: ['AWSPENDING']}), {'SecretId': ARN})
+
+    with pytest.raises(ValueError, match='Invalid step'):
+        app.handler(event('bogusSecret'), None)
+
+
+def test_handler_returns_early_for_current_token_without_caching(stubber):
+    stubber.add_response('describe_secret', metadata({TOKEN: ['AWSCURRENT']}), {'SecretId': ARN})
+
+    app.handler(event('finishSecret'), None)
+
+    assert app._METADATA_CACHE == {}
+
+
+def test_describe_secret_is_cached_per_token(stubber):
+    stubber.add_response('describe_secret', metadata({TOKEN: ['AWSPENDING']}), {'SecretId': ARN})
+
+    first = app.describe_secret(app.SECRETS_CLIENT, ARN, TOKEN)
+    second = app.describe_secret(app.SECRETS_CLIENT, ARN, TOKEN)
+
+    assert first is second
+
+
+def test_describe_secret_evicts_expired_entries(stubber, monkeypatch):
+    app._METADATA_CACHE[ARN, 'old-token'] = (0, {})
+    monkeypatch.setattr(app.time, 'monotonic', lambda: 100.0)
+    stubber.add_response('describe_secret', metadata({TOKEN: ['AWSPENDING']}), {'SecretId': ARN})
+
+    app.describe_secret(app.SECRETS_CLIENT, ARN, TOKEN)
+
+    assert list(app._METADATA_CACHE) == [(ARN, TOKEN)]
+
+
+def test_create_secret_skips_existing_pending_version(stubber):
+    stubber.add_response('get_secret_value', secret_value({'username': 'U', 'password': 'PW'}),
+                         {'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+
+    app.create_secret(app.SECRETS_CLIENT, ARN, TOKEN, metadata({TOKEN: ['AWSPENDING']}))
+
+
+def test_create_secret_carries_over_current_keys(stubber, monkeypatch):
+    monkeypatch.setattr(app, 'ThreadPoolExecutor', SerialExecutor)
+    stubber.add_client_error('get_secret_value', 'ResourceNotFoundException',
+                             expected_params={'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+    stubber.add_response('get_secret_value',
+                         secret_value({'username': 'U', 'password': 'OLD', 'account': 'acct'}, CURRENT),
+                         {'SecretId': ARN, 'VersionStage': 'AWSCURRENT'})
+    stubber.add_response('get_random_password', {'RandomPassword': 'NEWPW'},
+                         {'ExcludeCharacters': app.EXCLUDE_CHARACTERS})
+    stubber.add_response('put_secret_value', {'ARN': ARN, 'VersionId': TOKEN},
+                         {'SecretId': ARN, 'ClientRequestToken': TOKEN,
+                          'SecretString': '{"username":"U","password":"NEWPW","account":"acct"}',
+                          'VersionStages': ['AWSPENDING']})
+
+    app.create_secret(app.SECRETS_CLIENT, ARN, TOKEN, metadata({TOKEN: ['AWSPENDING']}, tags={'username': 'U'}))
+
+
+def test_create_secret_uses_username_tag_when_marked(stubber):
+    stubber.add_client_error('get_secret_value', 'ResourceNotFoundException',
+                             expected_params={'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+    stubber.add_response('get_random_password', {'RandomPassword': 'NEWPW'},
+                         {'ExcludeCharacters': app.EXCLUDE_CHARACTERS})
+    stubber.add_response('put_secret_value', {'ARN': ARN, 'VersionId': TOKEN},
+                         {'SecretId': ARN, 'ClientRequestToken': TOKEN,
+                          'SecretString': '{"username":"U","password":"NEWPW"}', 'VersionStages': ['AWSPENDING']})
+
+    tags = {'username': 'U', 'username_only_secret': 'true'}
+    app.create_secret(app.SECRETS_CLIENT, ARN, TOKEN, metadata({TOKEN: ['AWSPENDING']}, tags=tags))
+
+
+def test_set_secret_binds_username_and_password(stubber, monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(app, '_get_snow', lambda service_client: connection)
+    stubber.add_response('get_secret_value', secret_value({'username': 'U', 'password': "pw'; DROP USER X; --"}),
+                         {'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+
+    app.set_secret(app.SECRETS_CLIENT, ARN, TOKEN, None)
+
+    sql, params, _ = connection.cursor().executed[0]
+    assert sql == "ALTER USER IDENTIFIER(%s) SET PASSWORD=%s;"
+    assert params == ('U', "pw'; DROP USER X; --")
+    assert connection.cursor().closed
+    assert not connection.closed
+
+
+def test_set_secret_uses_role_statement_without_connect_role(stubber, monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(app, '_get_snow', lambda service_client: connection)
+    monkeypatch.setattr(app, 'CONNECT_AS_SECURITYADMIN', False)
+    stubber.add_response('get_secret_value', secret_value({'username': 'U', 'password': 'NEWPW'}),
+                         {'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+
+    app.set_secret(app.SECRETS_CLIENT, ARN, TOKEN, None)
+
+    assert connection.cursor().executed == [
+        ("USE ROLE SECURITYADMIN; ALTER USER IDENTIFIER(%s) SET PASSWORD=%s;", ('U', 'NEWPW'), {'num_statements': 2})
+    ]
+
+
+def test_get_snow_reuses_live_connection(stubber, connector):
+    svc_secret = secret_value({'terraform_bot_password': 'SVCPW'})
+    stubber.add_response('get_secret_value', svc_secret, {'SecretId': SVC_ARN, 'VersionStage': 'AWSCURRENT'})
+
+    first = app._get_snow(app.SECRETS_CLIENT)
+    second = app._get_snow(app.SECRETS_CLIENT)
+
+    assert first is second
+    assert len(connector.calls) == 1
+
+
+def test_get_snow_reconnects_after_expired_session(stubber, connector):
+    svc_secret = secret_value({'terraform_bot_password': 'SVCPW'})
+    stubber.add_response('get_secret_value', svc_secret, {'SecretId': SVC_ARN, 'VersionStage': 'AWSCURRENT'})
+    stubber.add_response('get_secret_value', svc_secret, {'SecretId': SVC_ARN, 'VersionStage': 'AWSCURRENT'})
+
+    stale = app._get_snow(app.SECRETS_CLIENT)
+    stale._cursor.error = ProgrammingError(msg='Session no longer exists', errno=390111)
+    fresh = app._get_snow(app.SECRETS_CLIENT)
+
+    assert fresh is not stale
+    assert stale.closed
+    assert len(connector.calls) == 2
+
+
+def test_test_secret_connects_with_pending_credentials(stubber, connector):
+    stubber.add_response('get_secret_value', secret_value({'username': 'U', 'password': 'NEWPW'}),
+                         {'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+
+    app.test_secret(app.SECRETS_CLIENT, ARN, TOKEN, None)
+
+    assert connector.calls == [{'username': 'U', 'password': 'NEWPW'}]
+    assert connector.connections[0].closed
+
+
+@pytest.fixture
+def cold_connector(tmp_path, monkeypatch):
+    """Importable bi_snowflake_connector that is not loaded yet, recording the thread that imported it"""
+    (tmp_path / 'bi_snowflake_connector.py').write_text(
+        'import threading\n'
+        'imported_by = threading.current_thread()\n'
+        'calls = []\n'
+        'class Connection:\n'
+        '    def close(self):\n'
+        '        pass\n'
+        'def connect(**kwargs):\n'
+        '    calls.append(kwargs)\n'
+        '    return Connection()\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'bi_snowflake_connector', raising=False)
+    yield
+    sys.modules.pop('bi_snowflake_connector', None)
+
+
+def test_test_secret_imports_connector_on_worker_when_cold(stubber, cold_connector):
+    stubber.add_response('get_secret_value', secret_value({'username': 'U', 'password': 'NEWPW'}),
+                         {'SecretId': ARN, 'VersionId': TOKEN, 'VersionStage': 'AWSPENDING'})
+
+    app.test_secret(app.SECRETS_CLIENT, ARN, TOKEN, None)
+
+    module = sys.modules['bi_snowflake_connector']
+    assert module.imported_by is not threading.main_thread()
+    assert module.calls == [{'username': 'U', 'password': 'NEWPW'}]
+
+
+def test_finish_secret_moves_current_and_cleans_stale_pending(stubber):
+    app._METADATA_CACHE[ARN, TOKEN] = (float('inf'), {})
+    stubber.add_response('update_secret_version_stage', {'ARN': ARN},
+                         {'SecretId': ARN, 'VersionStage': 'AWSCURRENT', 'MoveToVersionId': TOKEN,
+                          'RemoveFromVersionId': CURRENT})
+    stubber.add_response('update_secret_version_stage', {'ARN': ARN},
+                         {'SecretId': ARN, 'VersionStage': 'AWSPENDING', 'RemoveFromVersionId': STALE})
+
+    versions = {TOKEN: ['AWSPENDING'], CURRENT: ['AWSCURRENT'], STALE: ['AWSPENDING']}
+    app.finish_secret(app.SECRETS_CLIENT, ARN, TOKEN, metadata(versions))
+
+    assert app._METADATA_CACHE == {}
+
+
+def test_finish_secret_pages_versions_when_describe_is_truncated(stubber):
+    versions = {'%032d' % i: [] for i in range(app.DESCRIBE_VERSION_LIMIT - 2)}
+    versions.update({TOKEN: ['AWSPENDING'], CURRENT: ['AWSCURRENT']})
+    stubber.add_response('list_secret_version_ids',
+                         {'Versions': [{'VersionId': TOKEN, 'VersionStages': ['AWSPENDING']}], 'NextToken': 'page2'},
+                         {'SecretId': ARN, 'IncludeDeprecated': False, 'MaxResults': 100})
+    stubber.add_response('list_secret_version_ids',
+                         {'Versions': [{'VersionId': CURRENT, 'VersionStages': ['AWSCURRENT']},
+                                       {'VersionId': STALE, 'VersionStages': ['AWSPENDING']}]},
+                         {'SecretId': ARN, 'IncludeDeprecated': False, 'MaxResults': 100, 'NextToken': 'page2'})
+    stubber.add_response('update_secret_version_stage', {'ARN': ARN},
+                         {'SecretId': ARN, 'VersionStage': 'AWSCURRENT', 'MoveToVersionId': TOKEN,
+                          'RemoveFromVersionId': CURRENT})
+    stubber.add_response('update_secret_version_stage', {'ARN': ARN},
+                         {'SecretId': ARN, 'VersionStage': 'AWSPENDING', 'RemoveFromVersionId': STALE})
+
+    app.finish_secret(app.SECRETS_CLIENT, ARN, TOKEN, metadata(versions))